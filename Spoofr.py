@@ -1,11 +1,18 @@
 import logging
 import time
 import json
+import mmap
 import os
+import queue
 import random
 import re
+import select
+import socket
 import subprocess
-from threading import Lock
+import atexit
+import itertools
+from collections import namedtuple
+from threading import Event, Lock, Thread
 import pwnagotchi.ui.components as components
 import pwnagotchi.ui.view as view
 import pwnagotchi.ui.fonts as fonts
@@ -13,9 +20,51 @@ import pwnagotchi.plugins as plugins
 import pwnagotchi
 
 try:
-    import gpsd
+    from pyroute2 import IPRoute
 except ImportError:
-    gpsd = None
+    IPRoute = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Current spoofed identity: type is "wifi" or "bluetooth"
+Spoof = namedtuple("Spoof", "type name")
+
+
+def _json_dumps(obj):
+    """Serialize to UTF-8 JSON bytes, preferring orjson"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def _json_loads(data):
+    """Parse JSON from bytes or str, preferring orjson"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _random_mac():
+    """Return a random unicast, locally administered MAC address"""
+    mac_bytes = os.urandom(6)
+    # Clear the multicast bit and set the locally administered bit
+    return (bytes(((mac_bytes[0] & 0xFE) | 0x02,)) + mac_bytes[1:]).hex(":")
+
+
+def _spawn(argv):
+    """Run argv with posix_spawnp and wait for it, raising CalledProcessError on a non-zero exit.
+
+    Skips subprocess's close_fds scan; our descriptors are non-inheritable by default (PEP 446).
+    """
+    pid = os.posix_spawnp(argv[0], argv, os.environ)
+    _, status = os.waitpid(pid, 0)
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, argv)
+
 
 class Spoofr(plugins.Plugin):
     __author__ = ""
@@ -31,7 +80,7 @@ class Spoofr(plugins.Plugin):
     """
     __dependencies__ = {
         "apt": ["gpsd", "gpsd-clients", "hostapd", "bluez"],
-        "pip": ["gpsd-py3"]
+        "pip": ["pyroute2", "orjson"]
     }
     __defaults__ = {
         "enabled": False,
@@ -49,18 +98,109 @@ class Spoofr(plugins.Plugin):
         "wifi_interface": "wlan0"
     }
 
+    _HOSTAPD_CONF = "/etc/hostapd/hostapd.conf"
+    _HOSTAPD_CTRL_DIR = "/var/run/hostapd"
+    _SSID_RE = re.compile(rb"^ssid=(.*)$", re.M)
+
+    # Dashboard page served by on_webhook, pre-split at its {} slots into encoded constant segments
+    _HTML_SEGMENTS = tuple(segment.encode() for segment in """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Spoofr Dashboard</title>
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+        <style>
+            body { padding: 20px; background-color: #f8f9fa; }
+            .card { margin-bottom: 20px; }
+            .btn { margin-right: 10px; }
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1 class="text-center mb-4">Spoofr Dashboard</h1>
+            <div class="card">
+                <div class="card-header">Current Spoof</div>
+                <div class="card-body">
+                    <p><strong>Status:</strong> {}</p>
+                    <button class="btn btn-danger" onclick="sendAction('revert')">Stop Spoofing</button>
+                </div>
+            </div>
+            <div class="card">
+                <div class="card-header">Detected Devices (PwnDetector)</div>
+                <div class="card-body">
+                    <h5>Pwnagotchis</h5>
+                    <ul class="list-group mb-3">
+                        {}
+                    </ul>
+                    <h5>Flipper Zeros</h5>
+                    <ul class="list-group mb-3">
+                        {}
+                    </ul>
+                    <h5>Spoof a Device</h5>
+                    <select id="spoofTarget" class="form-select mb-3">
+                        <option value="">Select a device</option>
+                        {}
+                    </select>
+                    <button class="btn btn-primary" onclick="spoofDevice()">Spoof Selected</button>
+                </div>
+            </div>
+            <div class="card">
+                <div class="card-header">GPS Data</div>
+                <div class="card-body">
+                    {}
+                </div>
+            </div>
+        </div>
+        <script>
+            function sendAction(action) {
+                fetch('/plugins/spoofr', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({action: action})
+                }).then(() => location.reload());
+            }
+            function spoofDevice() {
+                const select = document.getElementById('spoofTarget');
+                const [type, name] = select.value.split('|');
+                if (type && name) {
+                    fetch('/plugins/spoofr', {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/json'},
+                        body: JSON.stringify({action: 'spoof', type: type, name: name})
+                    }).then(() => location.reload());
+                }
+            }
+        </script>
+    </body>
+    </html>
+    """.split("{}"))
+
     def __init__(self):
         self._lock = Lock()
         self._gps_available = False
-        self._gps = None
+        self._gps_sock = None
+        self._gps_thread = None
+        self._gps_latest = None  # Latest fix pushed by gpsd, replaced as a whole
         self._last_spoof = 0
-        self._current_spoof = None  # {"type": "wifi" or "bluetooth", "name": str}
+        self._current_spoof = None  # Spoof or None
+        self._last_display_text = None
         self._original_ssid = None
         self._original_bt_name = None
         self._original_mac = None
+        self._original_hostapd_conf = None
+        self._ipr = None
+        self._wifi_index = None
+        self._log_fh = None
+        self._log_q = queue.Queue()
+        self._log_thread = None
+        self._work_q = queue.Queue(maxsize=4)
+        self._work_thread = None
+        self._stopping = Event()
 
     def on_loaded(self):
         logging.info("[Spoofr] Plugin loaded")
+        self._stopping.clear()
         # Validate UI position
         if not isinstance(self.options["ui_position"], (list, tuple)) or len(self.options["ui_position"]) != 2:
             logging.error(f"[Spoofr] Invalid ui_position: {self.options['ui_position']}. Using default.")
@@ -79,20 +219,31 @@ class Spoofr(plugins.Plugin):
             except Exception as e:
                 logging.error(f"[Spoofr] Failed to create log directory {log_dir}: {str(e)}")
                 self.options["log_file"] = ""
+        # Open log file once and hand writes to a background flusher
+        if self.options["log_file"]:
+            try:
+                self._log_fh = open(self.options["log_file"], "ab", buffering=64 * 1024)
+                self._log_thread = Thread(target=self._log_worker, name="spoofr-log", daemon=True)
+                self._log_thread.start()
+                atexit.register(self._close_log)
+            except Exception as e:
+                logging.error(f"[Spoofr] Failed to open log file {self.options['log_file']}: {str(e)}")
+                self._log_fh = None
         # Initialize GPS
-        if self.options["gps_enabled"] and gpsd:
+        if self.options["gps_enabled"]:
             try:
-                gpsd.connect(self.options["gpsd_host"], self.options["gpsd_port"])
-                self._gps = gpsd
+                self._gps_sock = self._gps_connect()
                 self._gps_available = True
+                self._gps_thread = Thread(target=self._gps_reader, name="spoofr-gps", daemon=True)
+                self._gps_thread.start()
                 logging.info(f"[Spoofr] GPSD connected at {self.options['gpsd_host']}:{self.options['gpsd_port']}")
             except Exception as e:
                 logging.error(f"[Spoofr] Failed to connect to GPSD: {str(e)}")
                 self._gps_available = False
         else:
-            logging.info("[Spoofr] GPS disabled or gpsd-py3 not installed")
+            logging.info("[Spoofr] GPS disabled")
             self._gps_available = False
-        # Save original settings
+        # Save original settings; these are the only reads, revert uses the cached values
         try:
             self._original_ssid = self._get_current_ssid()
             self._original_bt_name = self._get_current_bt_name()
@@ -100,6 +251,26 @@ class Spoofr(plugins.Plugin):
             logging.info(f"[Spoofr] Original settings: SSID={self._original_ssid}, BT={self._original_bt_name}, MAC={self._original_mac}")
         except Exception as e:
             logging.error(f"[Spoofr] Failed to save original settings: {str(e)}")
+        try:
+            with open(self._HOSTAPD_CONF, "rb") as f:
+                self._original_hostapd_conf = f.read()
+        except Exception as e:
+            logging.error(f"[Spoofr] Failed to cache {self._HOSTAPD_CONF}: {str(e)}")
+        # Open netlink handle for MAC changes
+        if IPRoute:
+            try:
+                self._ipr = IPRoute()
+                self._wifi_index = self._ipr.link_lookup(ifname=self.options["wifi_interface"])[0]
+            except Exception as e:
+                logging.error(f"[Spoofr] Failed to open netlink for {self.options['wifi_interface']}: {str(e)}")
+                if self._ipr:
+                    self._ipr.close()
+                self._ipr = None
+        else:
+            logging.info("[Spoofr] pyroute2 not installed, falling back to ip -batch for MAC changes")
+        # Spoof changes run here so on_wifi_update never blocks the agent
+        self._work_thread = Thread(target=self._worker_loop, name="spoofr-worker", daemon=True)
+        self._work_thread.start()
         # Add UI element
         self._ui_elements()
 
@@ -113,20 +284,46 @@ class Spoofr(plugins.Plugin):
                 color=view.BLACK,
                 name="spoof_info"
             )
+            self._last_display_text = "Spoof: None"
 
     def on_unloaded(self):
         logging.info("[Spoofr] Plugin unloaded")
-        self._revert_spoof()
+        self._stopping.set()
+        if self._work_thread:
+            self._work_thread.join(timeout=5)
+            self._work_thread = None
+        # Drop stale requests so they are not applied after the next on_loaded
+        while True:
+            try:
+                self._work_q.get_nowait()
+            except queue.Empty:
+                break
+        if self._gps_sock:
+            try:
+                # Unblocks the reader thread's pending read
+                self._gps_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._gps_thread:
+            self._gps_thread.join(timeout=5)
+            self._gps_thread = None
+        with self._lock:
+            self._revert_spoof()
         with self._lock:
             components.remove("spoof_info")
+        if self._ipr:
+            self._ipr.close()
+            self._ipr = None
+        self._close_log()
 
     def _get_current_ssid(self):
         """Get current Wi-Fi SSID from hostapd.conf"""
         try:
-            with open("/etc/hostapd/hostapd.conf", "r") as f:
-                for line in f:
-                    if line.startswith("ssid="):
-                        return line.strip().split("=")[1]
+            with open(self._HOSTAPD_CONF, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    match = self._SSID_RE.search(mm)
+                    if match:
+                        return match.group(1).decode().strip()
         except Exception as e:
             logging.error(f"[Spoofr] Failed to read SSID: {str(e)}")
         return "pwnagotchi"
@@ -134,7 +331,7 @@ class Spoofr(plugins.Plugin):
     def _get_current_bt_name(self):
         """Get current Bluetooth device name"""
         try:
-            result = subprocess.check_output(["hciconfig", self.options["bluetooth_interface"], "name"]).decode()
+            result = subprocess.check_output(["hciconfig", self.options["bluetooth_interface"], "name"], close_fds=False).decode()
             return result.strip().split(": ")[1]
         except Exception:
             return "pwnagotchi"
@@ -142,60 +339,169 @@ class Spoofr(plugins.Plugin):
     def _get_current_mac(self):
         """Get current Wi-Fi MAC address"""
         try:
-            result = subprocess.check_output(["ifconfig", self.options["wifi_interface"]]).decode()
-            for line in result.split("\n"):
-                if "ether" in line:
-                    return line.strip().split("ether")[1].strip().split()[0]
+            with open(f"/sys/class/net/{self.options['wifi_interface']}/address") as f:
+                return f.read().strip()
         except Exception:
             return None
 
+    def _gps_connect(self):
+        """Connect to gpsd and enable JSON watch mode"""
+        sock = socket.create_connection((self.options["gpsd_host"], self.options["gpsd_port"]), timeout=5)
+        sock.settimeout(None)
+        sock.sendall(b'?WATCH={"enable":true,"json":true}\n')
+        return sock
+
+    def _gps_reader(self):
+        """Track the latest TPV report pushed by gpsd, reconnecting on errors"""
+        satellites = 0
+        while not self._stopping.is_set():
+            try:
+                if not self._gps_sock:
+                    self._gps_sock = self._gps_connect()
+                with self._gps_sock.makefile("rb") as stream:
+                    for line in stream:
+                        report = _json_loads(line)
+                        if report.get("class") == "SKY":
+                            if "uSat" in report:
+                                satellites = report["uSat"]
+                            else:
+                                satellites = sum(1 for sat in report.get("satellites", []) if sat.get("used"))
+                        elif report.get("class") == "TPV":
+                            mode = report.get("mode", 0)
+                            if mode >= 2:
+                                self._gps_latest = {
+                                    "Latitude": report.get("lat", 0),
+                                    "Longitude": report.get("lon", 0),
+                                    "Altitude": report.get("alt", report.get("altMSL", 0)) if mode == 3 else 0,
+                                    "Time": report.get("time"),
+                                    "Satellites": satellites
+                                }
+                            else:
+                                self._gps_latest = None
+                raise ConnectionError("gpsd closed the connection")
+            except Exception as e:
+                self._gps_latest = None
+                if self._gps_sock:
+                    self._gps_sock.close()
+                    self._gps_sock = None
+                if self._stopping.is_set():
+                    break
+                logging.warning(f"[Spoofr] GPS reader error: {str(e)}")
+                self._stopping.wait(5)
+
     def _get_gps_data(self):
-        """Fetch current GPS coordinates"""
+        """Return the latest GPS fix kept by the reader thread"""
         if not self._gps_available:
             return None
+        return self._gps_latest
+
+    def _set_mac(self, mac):
+        """Set Wi-Fi MAC address, cycling the link down and up"""
+        if self._ipr:
+            self._ipr.link("set", index=self._wifi_index, state="down")
+            self._ipr.link("set", index=self._wifi_index, address=mac)
+            self._ipr.link("set", index=self._wifi_index, state="up")
+        else:
+            iface = self.options["wifi_interface"]
+            subprocess.run(
+                ["sudo", "ip", "-batch", "-"],
+                input=f"link set dev {iface} down\nlink set dev {iface} address {mac}\nlink set dev {iface} up\n",
+                text=True,
+                check=True
+            )
+
+    def _hostapd_ctrl(self, *commands):
+        """Send commands to hostapd's control socket in order, raising unless each is answered OK"""
+        ctrl_path = os.path.join(self._HOSTAPD_CTRL_DIR, self.options["wifi_interface"])
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
         try:
-            packet = self._gps.get_current()
-            if packet.mode >= 2:
-                return {
-                    "Latitude": packet.lat,
-                    "Longitude": packet.lon,
-                    "Altitude": packet.alt if packet.mode == 3 else 0,
-                    "Time": packet.time,
-                    "Satellites": packet.satellites_used
-                }
-            return None
-        except Exception as e:
-            logging.warning(f"[Spoofr] GPS data fetch error: {str(e)}")
-            return None
+            # hostapd replies to the sender's address; an abstract-namespace name needs no file on disk
+            sock.bind(f"\0spoofr_ctrl_{os.getpid()}")
+            for command in commands:
+                name = command.split(b" ", 1)[0].decode()
+                sock.sendto(command, ctrl_path)
+                ready, _, _ = select.select([sock], [], [], 0.5)
+                if not ready:
+                    raise TimeoutError(f"hostapd did not answer {name}")
+                reply = sock.recv(4096)
+                if not reply.startswith(b"OK"):
+                    raise RuntimeError(f"hostapd {name} failed: {reply.decode(errors='replace').strip()}")
+        finally:
+            sock.close()
+
+    def _update_hostapd(self, ssid, mac=None):
+        """Switch the running hostapd to ssid, and the interface to mac if given.
+
+        Restarts the service instead when there is no control socket.
+        """
+        if not os.path.exists(os.path.join(self._HOSTAPD_CTRL_DIR, self.options["wifi_interface"])):
+            if mac:
+                self._set_mac(mac)
+            subprocess.run(["sudo", "systemctl", "restart", "hostapd"], check=True)
+            return
+        set_ssid = b"SET ssid " + ssid.encode()
+        if not mac:
+            # RELOAD re-applies the in-memory config without re-reading hostapd.conf, so SET the SSID first
+            self._hostapd_ctrl(set_ssid, b"RELOAD")
+            return
+        # SET before DISABLE so a rejected SSID fails while the AP is still up
+        self._hostapd_ctrl(set_ssid)
+        # hostapd only reads its BSSID at driver init, so re-init the interface around the MAC change
+        self._hostapd_ctrl(b"DISABLE")
+        try:
+            self._set_mac(mac)
+        finally:
+            self._hostapd_ctrl(b"ENABLE")
+
+    def _write_hostapd_conf(self, config):
+        """Atomically replace hostapd.conf; the temp file sits next to it so os.replace stays on one filesystem"""
+        tmp_path = self._HOSTAPD_CONF + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(config)
+        os.replace(tmp_path, self._HOSTAPD_CONF)
+
+    def _restore_hostapd_conf(self):
+        """Put back the hostapd.conf cached at load time"""
+        self._write_hostapd_conf(self._original_hostapd_conf)
+
+    def _restore_wifi(self):
+        """Put back the original hostapd.conf, SSID, and (if it was randomized) MAC"""
+        self._restore_hostapd_conf()
+        restore_mac = self.options["randomize_mac"] and self._original_mac
+        self._update_hostapd(self._original_ssid, self._original_mac if restore_mac else None)
 
     def _spoof_wifi(self, ssid):
         """Change Wi-Fi SSID and optionally MAC"""
+        # hostapd accepts 1-32 byte SSIDs; a newline would also inject extra lines into hostapd.conf
+        ssid_bytes = ssid.encode()
+        if not 0 < len(ssid_bytes) <= 32 or b"\n" in ssid_bytes or b"\r" in ssid_bytes:
+            logging.error(f"[Spoofr] Not spoofing Wi-Fi SSID: {ssid!r} is not a valid 1-32 byte single-line SSID")
+            return False
+        # Without the cached original there would be nothing to revert to
+        if self._original_hostapd_conf is None:
+            logging.error(f"[Spoofr] Not spoofing Wi-Fi SSID: original {self._HOSTAPD_CONF} was not cached at load")
+            return False
         try:
-            # Update hostapd.conf
-            with open("/etc/hostapd/hostapd.conf", "r") as f:
-                config = f.read()
-            config = re.sub(r"ssid=.*", f"ssid={ssid}", config)
-            with open("/tmp/hostapd.conf", "w") as f:
-                f.write(config)
-            subprocess.run(["sudo", "mv", "/tmp/hostapd.conf", "/etc/hostapd/hostapd.conf"], check=True)
-            # Change MAC if enabled
-            if self.options["randomize_mac"]:
-                new_mac = ":".join([f"{random.randint(0, 255):02x}" for _ in range(6)])
-                subprocess.run(["sudo", "ifconfig", self.options["wifi_interface"], "down"], check=True)
-                subprocess.run(["sudo", "ifconfig", self.options["wifi_interface"], "hw", "ether", new_mac], check=True)
-                subprocess.run(["sudo", "ifconfig", self.options["wifi_interface"], "up"], check=True)
-            # Restart hostapd
-            subprocess.run(["sudo", "systemctl", "restart", "hostapd"], check=True)
+            # Derive the spoofed config from the original so repeated spoofs never compound
+            ssid_line = b"ssid=" + ssid_bytes
+            self._write_hostapd_conf(self._SSID_RE.sub(lambda _: ssid_line, self._original_hostapd_conf, count=1))
+            # Apply to hostapd, changing MAC if enabled
+            self._update_hostapd(ssid, _random_mac() if self.options["randomize_mac"] else None)
             logging.info(f"[Spoofr] Spoofed Wi-Fi SSID to {ssid}")
             return True
         except Exception as e:
             logging.error(f"[Spoofr] Failed to spoof Wi-Fi SSID: {str(e)}")
+            # _current_spoof is not set on failure, so revert would never undo a partial spoof
+            try:
+                self._restore_wifi()
+            except Exception as restore_error:
+                logging.error(f"[Spoofr] Failed to roll back Wi-Fi spoof: {str(restore_error)}")
             return False
 
     def _spoof_bluetooth(self, name):
         """Change Bluetooth device name"""
         try:
-            subprocess.run(["sudo", "hciconfig", self.options["bluetooth_interface"], "name", name], check=True)
+            _spawn(["sudo", "hciconfig", self.options["bluetooth_interface"], "name", name])
             logging.info(f"[Spoofr] Spoofed Bluetooth name to {name}")
             return True
         except Exception as e:
@@ -203,16 +509,13 @@ class Spoofr(plugins.Plugin):
             return False
 
     def _revert_spoof(self):
-        """Revert to original SSID, Bluetooth name, and MAC"""
+        """Revert to original SSID, Bluetooth name, and MAC (caller holds self._lock)"""
         try:
-            if self._current_spoof:
-                if self._current_spoof["type"] == "wifi" and self._original_ssid:
-                    self._spoof_wifi(self._original_ssid)
-                    if self.options["randomize_mac"] and self._original_mac:
-                        subprocess.run(["sudo", "ifconfig", self.options["wifi_interface"], "down"], check=True)
-                        subprocess.run(["sudo", "ifconfig", self.options["wifi_interface"], "hw", "ether", self._original_mac], check=True)
-                        subprocess.run(["sudo", "ifconfig", self.options["wifi_interface"], "up"], check=True)
-                elif self._current_spoof["type"] == "bluetooth" and self._original_bt_name:
+            current_spoof = self._current_spoof
+            if current_spoof:
+                if current_spoof.type == "wifi" and self._original_hostapd_conf is not None:
+                    self._restore_wifi()
+                elif current_spoof.type == "bluetooth" and self._original_bt_name:
                     self._spoof_bluetooth(self._original_bt_name)
                 self._current_spoof = None
                 logging.info("[Spoofr] Reverted to original settings")
@@ -220,23 +523,60 @@ class Spoofr(plugins.Plugin):
             logging.error(f"[Spoofr] Failed to revert spoof: {str(e)}")
 
     def _log_spoof(self):
-        """Log spoofing action"""
-        if not self.options["log_file"]:
+        """Queue spoofing action for the log writer"""
+        if not self._log_fh:
             return
         try:
-            with self._lock:
-                gps_data = self._get_gps_data()
-                data = {
-                    "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "spoof": self._current_spoof,
-                    "gps": gps_data
-                }
-                with open(self.options["log_file"], "a") as f:
-                    json.dump(data, f)
-                    f.write("\n")
+            current_spoof = self._current_spoof
+            data = {
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "spoof": current_spoof._asdict() if current_spoof else None,
+                "gps": self._get_gps_data()
+            }
+            self._log_q.put_nowait(_json_dumps(data) + b"\n")
         except Exception as e:
             logging.error(f"[Spoofr] Failed to log to {self.options['log_file']}: {str(e)}")
 
+    def _log_worker(self):
+        """Batch queued log records into the buffered file, flushing about once a second"""
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self._log_q.get(timeout=1.0))
+                while len(batch) < 64:
+                    batch.append(self._log_q.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                batch.remove(None)
+                running = False
+            try:
+                if batch:
+                    self._log_fh.write(b"".join(batch))
+                now = time.monotonic()
+                if not running or now - last_flush >= 1.0:
+                    self._log_fh.flush()
+                    last_flush = now
+            except Exception as e:
+                logging.error(f"[Spoofr] Failed to log to {self.options['log_file']}: {str(e)}")
+
+    def _close_log(self):
+        """Flush pending log records and close the log file"""
+        if not self._log_fh:
+            return
+        if self._log_thread and self._log_thread.is_alive():
+            self._log_q.put(None)
+            self._log_thread.join(timeout=5)
+        try:
+            self._log_fh.close()
+        except Exception as e:
+            logging.error(f"[Spoofr] Failed to close {self.options['log_file']}: {str(e)}")
+        self._log_fh = None
+        self._log_thread = None
+        atexit.unregister(self._close_log)
+
     def on_wifi_update(self, agent, access_points):
         """Check for spoofing opportunities"""
         current_time = time.time()
@@ -245,46 +585,71 @@ class Spoofr(plugins.Plugin):
         self._last_spoof = current_time
         if "pwn_detector" not in plugins.loaded:
             logging.warning("[Spoofr] PwnDetector not loaded, cannot spoof")
-            self._revert_spoof()
-            self._update_ui()
+            self._queue_spoof(None)
             return
         pwn_detector = plugins.loaded["pwn_detector"]
+        pwnagotchis = pwn_detector._pwnagotchis if "pwnagotchi" in self.options["spoof_targets"] else {}
+        flippers = pwn_detector._flippers if "flipper" in self.options["spoof_targets"] else {}
+        total = len(pwnagotchis) + len(flippers)
+        if not total:
+            self._queue_spoof(None)
+            return
+        # Pick a random index across both device maps and only build that candidate
+        i = random.randrange(total)
+        if i < len(pwnagotchis):
+            info = next(itertools.islice(pwnagotchis.values(), i, None))
+            new_spoof = Spoof("wifi", info["name"])
+        else:
+            info = next(itertools.islice(flippers.values(), i - len(pwnagotchis), None))
+            new_spoof = Spoof(info["type"].lower(), info["name"])
+        self._queue_spoof(new_spoof)
+
+    def _queue_spoof(self, new_spoof):
+        """Hand a spoof change to the worker thread, dropping it if the worker is backed up"""
+        try:
+            self._work_q.put_nowait(new_spoof)
+        except queue.Full:
+            logging.debug("[Spoofr] Spoof worker busy, dropping stale update")
+
+    def _worker_loop(self):
+        """Apply queued spoof changes until the plugin is unloaded"""
+        while not self._stopping.is_set():
+            try:
+                new_spoof = self._work_q.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                self._apply_spoof(new_spoof)
+            except Exception as e:
+                logging.error(f"[Spoofr] Spoof worker error: {str(e)}")
+
+    def _apply_spoof(self, new_spoof):
+        """Switch to new_spoof, or revert to original settings when it is None"""
         with self._lock:
-            candidates = []
-            if "pwnagotchi" in self.options["spoof_targets"]:
-                candidates.extend(
-                    {"type": "wifi", "name": info["name"]}
-                    for info in pwn_detector._pwnagotchis.values()
-                )
-            if "flipper" in self.options["spoof_targets"]:
-                candidates.extend(
-                    {"type": info["type"].lower(), "name": info["name"]}
-                    for info in pwn_detector._flippers.values()
-                )
-            if not candidates:
+            if new_spoof is None:
                 self._revert_spoof()
-                self._update_ui()
-                return
-            # Select a random candidate
-            new_spoof = random.choice(candidates)
-            if new_spoof != self._current_spoof:
+            elif new_spoof != self._current_spoof:
                 self._revert_spoof()
-                if new_spoof["type"] == "wifi":
-                    success = self._spoof_wifi(new_spoof["name"])
+                if new_spoof.type == "wifi":
+                    success = self._spoof_wifi(new_spoof.name)
                 else:
-                    success = self._spoof_bluetooth(new_spoof["name"])
+                    success = self._spoof_bluetooth(new_spoof.name)
                 if success:
                     self._current_spoof = new_spoof
                     self._log_spoof()
-            self._update_ui()
+        self._update_ui()
 
     def _update_ui(self):
         """Update UI with current spoofed identity"""
-        with self._lock:
-            display_text = "Spoof: None"
-            if self._current_spoof:
-                display_text = f"Spoof: {self._current_spoof['name'][:20]}\n{self._current_spoof['type'].title()}"
-            components.update("spoof_info", value=display_text)
+        # _current_spoof is only ever replaced wholesale, so a single read is a consistent snapshot
+        current_spoof = self._current_spoof
+        display_text = "Spoof: None"
+        if current_spoof:
+            display_text = f"Spoof: {current_spoof.name[:20]}\n{current_spoof.type.title()}"
+        if display_text == self._last_display_text:
+            return
+        self._last_display_text = display_text
+        components.update("spoof_info", value=display_text)
 
     def on_ui_update(self, ui):
         """Ensure on-screen UI is refreshed"""
@@ -295,105 +660,40 @@ class Spoofr(plugins.Plugin):
         if path == "/spoofr":
             if request.method == "POST":
                 try:
-                    data = json.loads(request.body.decode())
+                    data = _json_loads(request.body)
                     if "action" in data:
                         if data["action"] == "revert":
-                            self._revert_spoof()
+                            self._apply_spoof(None)
                         elif data["action"] == "spoof" and "type" in data and "name" in data:
-                            with self._lock:
-                                self._revert_spoof()
-                                new_spoof = {"type": data["type"], "name": data["name"]}
-                                success = self._spoof_wifi(new_spoof["name"]) if new_spoof["type"] == "wifi" else self._spoof_bluetooth(new_spoof["name"])
-                                if success:
-                                    self._current_spoof = new_spoof
-                                    self._log_spoof()
-                            self._update_ui()
-                    return json.dumps({"status": "success"})
+                            self._apply_spoof(Spoof(data["type"], data["name"]))
+                    return _json_dumps({"status": "success"}).decode()
                 except Exception as e:
                     logging.error(f"[Spoofr] Webhook POST error: {str(e)}")
-                    return json.dumps({"status": "error", "message": str(e)})
+                    return _json_dumps({"status": "error", "message": str(e)}).decode()
             # GET request: Serve HTML dashboard
             pwn_detector = plugins.loaded.get("pwn_detector", None)
             pwnagotchis = pwn_detector._pwnagotchis if pwn_detector else {}
             flippers = pwn_detector._flippers if pwn_detector else {}
             gps_data = self._get_gps_data()
-            html = """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Spoofr Dashboard</title>
-                <meta name="viewport" content="width=device-width, initial-scale=1">
-                <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
-                <style>
-                    body { padding: 20px; background-color: #f8f9fa; }
-                    .card { margin-bottom: 20px; }
-                    .btn { margin-right: 10px; }
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1 class="text-center mb-4">Spoofr Dashboard</h1>
-                    <div class="card">
-                        <div class="card-header">Current Spoof</div>
-                        <div class="card-body">
-                            <p><strong>Status:</strong> {}</p>
-                            <button class="btn btn-danger" onclick="sendAction('revert')">Stop Spoofing</button>
-                        </div>
-                    </div>
-                    <div class="card">
-                        <div class="card-header">Detected Devices (PwnDetector)</div>
-                        <div class="card-body">
-                            <h5>Pwnagotchis</h5>
-                            <ul class="list-group mb-3">
-                                {}
-                            </ul>
-                            <h5>Flipper Zeros</h5>
-                            <ul class="list-group mb-3">
-                                {}
-                            </ul>
-                            <h5>Spoof a Device</h5>
-                            <select id="spoofTarget" class="form-select mb-3">
-                                <option value="">Select a device</option>
-                                {}
-                            </select>
-                            <button class="btn btn-primary" onclick="spoofDevice()">Spoof Selected</button>
-                        </div>
-                    </div>
-                    <div class="card">
-                        <div class="card-header">GPS Data</div>
-                        <div class="card-body">
-                            {}
-                        </div>
-                    </div>
-                </div>
-                <script>
-                    function sendAction(action) {
-                        fetch('/plugins/spoofr', {
-                            method: 'POST',
-                            headers: {'Content-Type': 'application/json'},
-                            body: JSON.stringify({action: action})
-                        }).then(() => location.reload());
-                    }
-                    function spoofDevice() {
-                        const select = document.getElementById('spoofTarget');
-                        const [type, name] = select.value.split('|');
-                        if (type && name) {
-                            fetch('/plugins/spoofr', {
-                                method: 'POST',
-                                headers: {'Content-Type': 'application/json'},
-                                body: JSON.stringify({action: 'spoof', type: type, name: name})
-                            }).then(() => location.reload());
-                        }
-                    }
-                </script>
-            </body>
-            </html>
-            """
-            current_spoof = self._current_spoof["name"] + f" ({self._current_spoof['type'].title()})" if self._current_spoof else "None"
-            pwn_list = "".join(f'<li class="list-group-item">Name: {info["name"]}, RSSI: {info["rssi"]}, GPS: {info.get("gps", {})}</li>' for info in pwnagotchis.values())
-            flip_list = "".join(f'<li class="list-group-item">Name: {info["name"]}, Type: {info["type"]}, RSSI: {info["rssi"]}, GPS: {info.get("gps", {})}</li>' for info in flippers.values())
-            spoof_options = "".join(f'<option value="wifi|{info["name"]}">{info["name"]} (WiFi)</option>' for info in pwnagotchis.values()) + \
-                            "".join(f'<option value="{info["type"].lower()}|{info["name"]}">{info["name"]} ({info["type"]})</option>' for info in flippers.values())
+            spoof = self._current_spoof
+            current_spoof = f"{spoof.name} ({spoof.type.title()})" if spoof else "None"
+            pwn_items = []
+            flip_items = []
+            spoof_opts = []
+            for info in pwnagotchis.values():
+                pwn_items.append(f'<li class="list-group-item">Name: {info["name"]}, RSSI: {info["rssi"]}, GPS: {info.get("gps", {})}</li>')
+                spoof_opts.append(f'<option value="wifi|{info["name"]}">{info["name"]} (WiFi)</option>')
+            for info in flippers.values():
+                flip_items.append(f'<li class="list-group-item">Name: {info["name"]}, Type: {info["type"]}, RSSI: {info["rssi"]}, GPS: {info.get("gps", {})}</li>')
+                spoof_opts.append(f'<option value="{info["type"].lower()}|{info["name"]}">{info["name"]} ({info["type"]})</option>')
             gps_html = f"<p>Latitude: {gps_data['Latitude']:.4f}, Longitude: {gps_data['Longitude']:.4f}, Altitude: {gps_data['Altitude']:.1f}m</p>" if gps_data else "<p>No GPS data</p>"
-            return html.format(current_spoof, pwn_list or "<li class='list-group-item'>None</li>", flip_list or "<li class='list-group-item'>None</li>", spoof_options, gps_html)
+            segments = self._HTML_SEGMENTS
+            return b"".join((
+                segments[0], current_spoof.encode(),
+                segments[1], ("".join(pwn_items) or "<li class='list-group-item'>None</li>").encode(),
+                segments[2], ("".join(flip_items) or "<li class='list-group-item'>None</li>").encode(),
+                segments[3], "".join(spoof_opts).encode(),
+                segments[4], gps_html.encode(),
+                segments[5]
+            ))
         return None